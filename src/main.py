@@ -1,71 +1,523 @@
 import asyncio
+import atexit
+import hashlib
+import json
+import logging
+import logging.handlers
+import math
 import os
+import queue
+import re
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Final
+import httpx
 from dotenv import load_dotenv
 
 from microsoft_teams.api import MessageActivity, TypingActivityInput
 from microsoft_teams.apps import ActivityContext, App
 from microsoft_teams.devtools import DevToolsPlugin
-from microsoft.teams.ai import ChatPrompt
-from microsoft.teams.mcpplugin import McpClientPlugin, McpClientPluginParams
+from microsoft.teams.ai import ChatPrompt, SystemMessage
+from microsoft.teams.mcpplugin import McpCachedValue, McpClientPlugin, McpClientPluginParams, McpToolDetails
 from microsoft.teams.openai import OpenAICompletionsAIModel
+from openai import AsyncAzureOpenAI
+
+try:
+    import uvloop
+except ImportError:  # No Windows build; the default asyncio loop is used instead
+    uvloop = None
 
 # Load environment variables from .env file
 load_dotenv()
 
-# MCP Server Configuration - This is where all the tools live
-mcp_server_api_key = os.getenv('FASTMCP_API_KEY')
-calendar_mcp_server_url = "https://arvaya-availability.fastmcp.app/mcp"
-time_entry_mcp_server_url= "https://billi-tool.fastmcp.app/mcp"
-
-# Azure OpenAI Configuration - Just for LLM inference
-azure_model = os.getenv('AZURE_OPENAI_DEPLOYMENT')
-azure_endpoint = os.getenv('AZURE_OPENAI_ENDPOINT', '').rstrip('/')
-
-# Initialize Azure OpenAI model for ChatPrompt (LLM only - tools come from MCP)
-# The MCP server handles all tool execution - this is just for LLM inference
-azure_openai_model = OpenAICompletionsAIModel(
-    model=azure_model,
-    key=os.getenv('AZURE_OPENAI_API_KEY'),
-    base_url=f"{azure_endpoint}/openai/deployments",
-    api_version=os.getenv('AZURE_OPENAI_API_VERSION')
-)
 
-# The MCP server handles all tool execution and business logic
-mcp_plugin_booking = McpClientPlugin()
-mcp_plugin_booking.use_mcp_server(
-    calendar_mcp_server_url,
-    McpClientPluginParams(headers={
-        "Authorization": f"Bearer {mcp_server_api_key}",
-    })
-)
+@dataclass(frozen=True, slots=True)
+class Config:
+    """
+    Settings read from the environment once at startup.
+    Frozen so they can't drift at runtime; slots keep attribute access cheap.
+    Required variables raise KeyError at import instead of failing on the first message.
+    """
 
-mcp_plugin_time_entry = McpClientPlugin()
-mcp_plugin_time_entry.use_mcp_server(
-    time_entry_mcp_server_url,
-    McpClientPluginParams(headers={
-        "Authorization": f"Bearer {mcp_server_api_key}",
-    })
-)
+    # MCP Server Configuration - This is where all the tools live
+    mcp_server_api_key: str
+    # Azure OpenAI Configuration - Just for LLM inference
+    azure_model: str
+    azure_endpoint: str  # Trailing '/' already stripped
+    azure_api_key: str
+    azure_api_version: str
+    azure_embedding_deployment: str | None  # Enables the semantic tier of the response cache when set
+    response_cache_enabled: bool  # Reuse replies for repeated questions (off unless RESPONSE_CACHE_ENABLED=true)
+    # Runtime
+    environment: str
+    log_level: str
+    conv_history_max: int  # Maximum number of conversations kept in memory
+    llm_max_concurrency: int  # LLM calls allowed in flight at once
+    llm_max_queue: int  # Messages allowed to wait for an LLM slot before new ones are turned away
+    calendar_mcp_server_url: str = "https://arvaya-availability.fastmcp.app/mcp"
+    time_entry_mcp_server_url: str = "https://billi-tool.fastmcp.app/mcp"
+    mcp_tools_cache_path: str = os.path.expanduser("~/.cache/batool/mcp_tools.json")  # Tool lists persisted across restarts
+    mcp_tools_refetch_ms: int = 24 * 60 * 60 * 1000  # Age at which MCP tool lists are fetched again (SDK default: 1 day)
+
+    @classmethod
+    def from_env(cls) -> "Config":
+        return cls(
+            mcp_server_api_key=os.environ['FASTMCP_API_KEY'],
+            azure_model=os.environ['AZURE_OPENAI_DEPLOYMENT'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'].rstrip('/'),
+            azure_api_key=os.environ['AZURE_OPENAI_API_KEY'],
+            azure_api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            azure_embedding_deployment=os.getenv('AZURE_OPENAI_EMBEDDING_DEPLOYMENT'),
+            response_cache_enabled=os.getenv('RESPONSE_CACHE_ENABLED', '').lower() in ('1', 'true', 'yes'),
+            environment=os.getenv('ENVIRONMENT', ''),
+            log_level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+            conv_history_max=int(os.getenv('CONV_HISTORY_MAX', '10000')),
+            llm_max_concurrency=int(os.getenv('LLM_MAX_CONCURRENCY', '16')),
+            llm_max_queue=int(os.getenv('LLM_MAX_QUEUE', '128')),
+            mcp_tools_cache_path=os.path.expanduser(
+                os.getenv('MCP_TOOLS_CACHE_PATH', '~/.cache/batool/mcp_tools.json')
+            ),
+            mcp_tools_refetch_ms=int(os.getenv('MCP_TOOLS_REFETCH_MS', str(24 * 60 * 60 * 1000))),
+        )
 
-# Create ChatPrompt - Thin wrapper that connects Azure OpenAI (LLM) + MCP Server (Tools)
-# The MCP server does all the heavy lifting for tool execution
-chat_prompt = ChatPrompt(
-    model=azure_openai_model,
-    plugins=[mcp_plugin_booking, mcp_plugin_time_entry]
+    @property
+    def is_development(self) -> bool:
+        return self.environment.lower() == 'development'
+
+
+CFG = Config.from_env()
+
+# Logging - level is configurable via LOG_LEVEL (defaults to INFO)
+# Records are queued on the event loop thread and written to stderr by a listener thread,
+# so a slow stream never blocks message handling. Set up at import so it also applies under Uvicorn.
+# Only this module's logger is configured: the Teams SDK loggers have their own handlers and
+# propagate to root, so a root handler would print every SDK line twice
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logger = logging.getLogger(__name__)
+logger.setLevel(CFG.log_level)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+logger.propagate = False
+
+# One pooled HTTP client for all Azure OpenAI traffic (chat + embeddings) so TLS
+# connections are kept alive and reused across messages instead of re-handshaking
+azure_http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(60.0, connect=10.0),
+    transport=httpx.AsyncHTTPTransport(
+        retries=2,  # Retries failed connection attempts only
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+    ),
 )
+azure_openai_client = AsyncAzureOpenAI(
+    api_key=CFG.azure_api_key,
+    azure_endpoint=CFG.azure_endpoint,
+    api_version=CFG.azure_api_version,
+    http_client=azure_http_client,
+)
+
+def load_mcp_tools_cache(path: str) -> dict[str, McpCachedValue]:
+    """
+    Load MCP tool lists saved by a previous run so a restart can skip discovery.
+    A missing or unreadable file just means the tools are fetched from the servers.
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return {
+            url: McpCachedValue(
+                transport=entry.get("transport"),
+                available_tools=[McpToolDetails(**tool) for tool in entry["available_tools"]],
+                last_fetched=entry["last_fetched"],
+            )
+            for url, entry in data.items()
+        }
+    except FileNotFoundError:
+        return {}
+    except Exception:
+        logger.warning("Ignoring unreadable MCP tool cache at %s", path, exc_info=True)
+        return {}
+
+
+def save_mcp_tools_cache(path: str, cache: dict[str, McpCachedValue]) -> None:
+    """Write the MCP tool lists to disk, replacing the old file atomically."""
+    data = {
+        url: {
+            "transport": value.transport,
+            "available_tools": [tool.model_dump() for tool in value.available_tools],
+            "last_fetched": value.last_fetched,
+        }
+        for url, value in cache.items()
+        if value.available_tools
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def mcp_tools_fetched_at(cache: dict[str, McpCachedValue]) -> float:
+    """Time (ms) of the most recent tool list fetch recorded in the plugin cache."""
+    return max((value.last_fetched or 0.0 for value in cache.values()), default=0.0)
+
+
+# Fetch time of the tool lists currently on disk, so they are only rewritten after a refetch
+_mcp_tools_saved_at = 0.0
+
+
+async def persist_mcp_tools(mcp_plugin: McpClientPlugin) -> None:
+    """Save the plugin's tool lists if they were fetched since they were last loaded or saved."""
+    global _mcp_tools_saved_at
+    fetched_at = mcp_tools_fetched_at(mcp_plugin.cache)
+    if fetched_at <= _mcp_tools_saved_at:
+        return
+    _mcp_tools_saved_at = fetched_at
+    try:
+        await asyncio.to_thread(save_mcp_tools_cache, CFG.mcp_tools_cache_path, mcp_plugin.cache)
+    except Exception:
+        logger.warning("Could not save MCP tool cache to %s", CFG.mcp_tools_cache_path, exc_info=True)
+
+
+# ChatPrompt, its model wrapper and the MCP plugin are created on first use rather than at import,
+# so importing this module (smoke tests, tooling) doesn't set them up
+# Built together and stored as one pair so callers get both as non-optional values
+_chat_prompt: tuple[ChatPrompt, McpClientPlugin] | None = None
+_chat_prompt_lock = asyncio.Lock()
+
+
+async def get_chat_prompt_and_plugin() -> tuple[ChatPrompt, McpClientPlugin]:
+    """
+    Return the shared ChatPrompt and its MCP plugin, building them on first use.
+    Concurrent first callers wait on the lock so they are only built once.
+    """
+    global _chat_prompt, _mcp_tools_saved_at
+    if _chat_prompt is None:
+        async with _chat_prompt_lock:
+            if _chat_prompt is None:
+                # Initialize Azure OpenAI model for ChatPrompt (LLM only - tools come from MCP)
+                # The MCP server handles all tool execution - this is just for LLM inference
+                azure_openai_model = OpenAICompletionsAIModel(
+                    model=CFG.azure_model,
+                    client=azure_openai_client
+                )
+
+                # The MCP server handles all tool execution and business logic
+                # Both servers are registered on one plugin so their tool discovery (initialize + tools/list)
+                # runs concurrently instead of one plugin after the other
+                # Seeded with the tool lists saved by the last run; entries older than
+                # mcp_tools_refetch_ms are fetched again on the next build
+                mcp_tools_cache = await asyncio.to_thread(load_mcp_tools_cache, CFG.mcp_tools_cache_path)
+                _mcp_tools_saved_at = mcp_tools_fetched_at(mcp_tools_cache)
+                mcp_plugin = McpClientPlugin(
+                    cache=mcp_tools_cache,
+                    refetch_timeout_ms=CFG.mcp_tools_refetch_ms,
+                )
+                mcp_plugin.use_mcp_server(
+                    CFG.calendar_mcp_server_url,
+                    McpClientPluginParams(headers={
+                        "Authorization": f"Bearer {CFG.mcp_server_api_key}",
+                    })
+                )
+                mcp_plugin.use_mcp_server(
+                    CFG.time_entry_mcp_server_url,
+                    McpClientPluginParams(headers={
+                        "Authorization": f"Bearer {CFG.mcp_server_api_key}",
+                    })
+                )
+
+                # Create ChatPrompt - Thin wrapper that connects Azure OpenAI (LLM) + MCP Server (Tools)
+                # The MCP server does all the heavy lifting for tool execution
+                chat_prompt = ChatPrompt(
+                    model=azure_openai_model,
+                    plugins=[mcp_plugin]
+                )
+                _chat_prompt = (chat_prompt, mcp_plugin)
+    return _chat_prompt
+
+
+# System prompt for the LLM - built once at import and shared by every message
+BASE_INSTRUCTIONS: Final[str] = """CRITICAL SYSTEM REQUIREMENT
+Use only plain ASCII text: letters, numbers and basic punctuation (. , ! ? - ' "). No emojis or characters above ASCII 255 - they cause system errors.
+
+You are Billi, a friendly and efficient assistant for ARVAYA Consulting.
+You are a thin client that routes requests to MCP server tools. The MCP servers handle all date parsing, business logic and data processing - you only call tools with the user's exact information.
+
+## TOOLS
+Time entry server:
+- process_time_entry(messageText, userName) - log time, time entries, hours worked. messageText is the EXACT user message.
+
+Calendar server:
+- get_users_with_name_and_email(name) - find a person's email address
+- check_availability(user_email, ...) - availability, free time, schedule
+- book_meeting(user_email, subject, start_datetime, end_datetime, sender) - schedule or book a meeting
+
+## RULES
+1. Pass dates/times EXACTLY as the user wrote them ("tomorrow", "next Monday", "1/3/2026 9am"). Never convert or interpret them, and only state specific dates that come back in tool results.
+2. For availability or booking requests call a tool IMMEDIATELY - do not just greet. Given a person's name, call get_users_with_name_and_email first, then check_availability or book_meeting with the email.
+3. sender (booking) and userName (time entry) are the name from CURRENT USER CONTEXT.
+
+## EXAMPLES
+- "check availability of David Hogg" -> get_users_with_name_and_email("David Hogg"), then check_availability with the returned email
+- "book a meeting with Sarah tomorrow at 2pm" -> get_users_with_name_and_email("Sarah"), then book_meeting with start_datetime="tomorrow 2pm"
+- "who is John Smith" -> get_users_with_name_and_email("John Smith")
+- "log 4 hours for project X" -> process_time_entry(messageText="log 4 hours for project X")
+
+## STYLE
+- Greet briefly only when no action is requested
+- Be concise; after a tool runs, summarize its result"""
+
+# Pre-built system message - ChatPrompt would otherwise wrap the string in a new SystemMessage on every send
+SYSTEM_MESSAGE: Final[SystemMessage] = SystemMessage(content=BASE_INSTRUCTIONS)
+
+# Seconds to wait for the LLM before sending a typing indicator to Teams
+TYPING_INDICATOR_DELAY = 0.8
+
+class LRUConvStore(OrderedDict):
+    """
+    Per-conversation state store bounded to max_size entries (CONV_HISTORY_MAX).
+    Reads and writes mark a conversation as recently used; inserting past the
+    limit evicts the least recently used conversation.
+    """
+
+    def __init__(self, max_size: int = CFG.conv_history_max):
+        super().__init__()
+        self.max_size = max_size
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.max_size:
+            self.popitem(last=False)
+
 
 # Store conversation history per conversation thread
 # This preserves context that the MCP server needs
-conversation_history: dict[str, list] = {}
+# Each entry is a pre-formatted "User: ..." / "Assistant: ..." line, and the deque keeps
+# only the most recent exchanges so older lines are evicted automatically
+HISTORY_MAX_LINES = 10  # Last 5 exchanges (user + assistant)
+conversation_history: LRUConvStore = LRUConvStore()  # conversation_id -> deque[str]
+
+# Cache the user context strings per conversation thread
+# The sender rarely changes within a conversation, so these are only rebuilt when the name changes
+# Maps conversation_id -> (user_name, user_context_prefix, user_metadata_note)
+user_context_cache: LRUConvStore = LRUConvStore()
+
+# Response cache - reuses replies for repeated / near-duplicate questions
+# Opt-in via RESPONSE_CACHE_ENABLED: a cached reply skips the LLM and therefore any tool call, so
+# entries are scoped to one sender in one conversation and expire after RESPONSE_CACHE_TTL seconds
+# Near-duplicate matching additionally needs an Azure OpenAI embeddings deployment
+RESPONSE_CACHE_MAX_ENTRIES = 1024
+RESPONSE_CACHE_TTL = 300
+RESPONSE_CACHE_THRESHOLD = 0.92  # Minimum cosine similarity for a semantic cache hit
+SEMANTIC_CACHE_MAX_ENTRIES = 256
+# Short messages and ones referring back to earlier turns ("yes", "change it to 3pm") mean
+# something different after every turn, so they are never cached
+CACHE_MIN_WORDS = 4
+CONTEXTUAL_REFERENCE_RE = re.compile(r"\b(it|that|this|these|those|them)\b", re.IGNORECASE)
+# Messages mentioning any of these depend on the current date or trigger a tool action, so they always
+# reach the LLM - a cached reply would skip the tool call. Whole words only, so "login" or "blog" still cache
+UNCACHEABLE_RE = re.compile(
+    r"\b("
+    r"today|tonight|tomorrow|yesterday|now|week|month"
+    r"|monday|tuesday|wednesday|thursday|friday|saturday|sunday"
+    r"|book|booked|booking|schedule|scheduled|reschedule|cancel|meeting|meetings|call|calendar"
+    r"|availability|available|free|busy"
+    r"|log|logged|logging|submit|submitted|hour|hours|time entry|time entries|timesheet"
+    r")\b",
+    re.IGNORECASE,
+)
+
+
+class ResponseCache:
+    """
+    Cache of assistant replies for repeated questions.
+    Every entry belongs to a scope (one sender in one conversation) and is only ever
+    returned within that scope, until it expires after ttl seconds.
+    Exact repeats are found by a SHA-256 of the scope and message. When an embeddings deployment
+    is configured, near-duplicates in the same scope are also matched when the cosine similarity
+    of the embeddings reaches the threshold. Azure OpenAI embeddings are unit length, so cosine
+    similarity is just the dot product.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        client: AsyncAzureOpenAI | None = None,
+        deployment: str | None = None,
+        threshold: float = RESPONSE_CACHE_THRESHOLD,
+        ttl: float = RESPONSE_CACHE_TTL,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        max_semantic_entries: int = SEMANTIC_CACHE_MAX_ENTRIES,
+    ):
+        self.enabled = enabled
+        self.client = client
+        self.deployment = deployment
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_semantic_entries = max_semantic_entries
+        # key -> (expires_at, response)
+        self._exact: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        # key -> (scope, expires_at, embedding, response)
+        self._semantic: OrderedDict[str, tuple[str, float, list[float], str]] = OrderedDict()
+        self._lock = asyncio.Lock()
+
+    @property
+    def semantic_enabled(self) -> bool:
+        return self.enabled and self.client is not None and self.deployment is not None
+
+    @staticmethod
+    def is_cacheable(message: str) -> bool:
+        return (
+            not UNCACHEABLE_RE.search(message)
+            and len(message.split()) >= CACHE_MIN_WORDS
+            and not CONTEXTUAL_REFERENCE_RE.search(message)
+        )
+
+    @staticmethod
+    def key_for(text: str) -> str:
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    async def get(self, key: str) -> str | None:
+        if not self.enabled:
+            return None
+        async with self._lock:
+            entry = self._exact.get(key)
+            if entry is None:
+                return None
+            expires_at, response = entry
+            if expires_at <= time.monotonic():
+                del self._exact[key]
+                return None
+            self._exact.move_to_end(key)
+            return response
+
+    async def embed(self, text: str) -> list[float] | None:
+        if self.client is None or self.deployment is None:
+            return None
+        try:
+            response = await self.client.embeddings.create(model=self.deployment, input=text)
+        except Exception:
+            # The cache is an optimization - fall through to the LLM if embedding fails
+            logger.warning("Embedding request failed, bypassing response cache", exc_info=True)
+            return None
+        return response.data[0].embedding
+
+    def has_semantic_entries(self, scope: str) -> bool:
+        now = time.monotonic()
+        return any(
+            cached_scope == scope and expires_at > now
+            for cached_scope, expires_at, _, _ in self._semantic.values()
+        )
+
+    async def lookup(self, scope: str, embedding: list[float]) -> str | None:
+        async with self._lock:
+            now = time.monotonic()
+            best_key, best_score = None, self.threshold
+            for key, (cached_scope, expires_at, cached_embedding, _) in self._semantic.items():
+                if cached_scope != scope or expires_at <= now:
+                    continue
+                score = math.sumprod(embedding, cached_embedding)
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                return None
+            self._semantic.move_to_end(best_key)
+            return self._semantic[best_key][3]
+
+    async def store(
+        self, key: str, response: str, scope: str, embedding: list[float] | None = None
+    ) -> None:
+        if not self.enabled:
+            return
+        async with self._lock:
+            expires_at = time.monotonic() + self.ttl
+            self._exact[key] = (expires_at, response)
+            self._exact.move_to_end(key)
+            if len(self._exact) > self.max_entries:
+                self._exact.popitem(last=False)
+            if embedding is not None:
+                self._semantic[key] = (scope, expires_at, embedding, response)
+                self._semantic.move_to_end(key)
+                if len(self._semantic) > self.max_semantic_entries:
+                    self._semantic.popitem(last=False)
+
+
+response_cache = ResponseCache(
+    CFG.response_cache_enabled,
+    azure_openai_client if CFG.azure_embedding_deployment else None,
+    CFG.azure_embedding_deployment,
+)
+
+# LLM calls in flight for cacheable messages, keyed by response cache key, so an identical
+# question arriving while one is still being answered shares that call instead of paying for its own
+# The key includes the sender and conversation: a call runs tools as its sender, so it is never
+# shared with anyone else
+inflight_requests: dict[str, asyncio.Task] = {}
+
+
+class LLMLimiter:
+    """
+    Backpressure for LLM calls.
+    Up to max_concurrency calls run at once and up to max_queue more wait for a slot;
+    past that the limiter reports full so new messages are turned away instead of
+    piling up behind Azure OpenAI rate limits.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.pending = 0  # Calls running or waiting for a slot
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    @property
+    def full(self) -> bool:
+        return self.pending >= self.max_concurrency + self.max_queue
+
+    def reserve(self) -> bool:
+        """
+        Admit a call if there is room, counting it as pending immediately.
+        Checking and reserving in one synchronous step keeps the bound exact when several
+        handlers are admitted in the same loop tick. Every successful reserve must be followed by run().
+        """
+        if self.full:
+            return False
+        self.pending += 1
+        return True
+
+    async def run(self, coro):
+        """Run a call admitted by reserve(), releasing its reservation when it finishes."""
+        try:
+            async with self._slots:
+                return await coro
+        finally:
+            self.pending -= 1
+
+
+llm_limiter = LLMLimiter(CFG.llm_max_concurrency, CFG.llm_max_queue)
+BUSY_REPLY = "I'm handling a lot of requests right now. Please try again in a moment."
 
 # Configure plugins based on environment
 # DevToolsPlugin is for local development only - disable in production
 # Note: Empty plugins array is fine for production - App class works without plugins
 plugins = []
-environment = os.getenv('ENVIRONMENT', '').lower()
-is_development = environment == 'development'
 
-if is_development:
+if CFG.is_development:
     plugins.append(DevToolsPlugin())
     print("Running in DEVELOPMENT mode with DevToolsPlugin enabled")
 else:
@@ -80,19 +532,27 @@ app = App(plugins=plugins)
 # Expose ASGI app for Azure deployment with Uvicorn
 # The App class from microsoft-teams-apps wraps a Starlette application
 # We need to access the underlying Starlette app which is the actual ASGI application
-# Common patterns: app.app, app._app, or app.router.app
-try:
-    # Try different common attribute names for the underlying ASGI app
-    if hasattr(app, 'app') and callable(getattr(app, 'app', None)):
-        asgi_app = app.app
-        print("Found ASGI app at app.app")
-    elif hasattr(app, '_app') and callable(getattr(app, '_app', None)):
-        asgi_app = app._app
-        print("Found ASGI app at app._app")
-    elif hasattr(app, 'router') and hasattr(app.router, 'app'):
-        asgi_app = app.router.app
+# Known locations are checked in order: app.app, app._app, then app.router.app
+_ASGI_ATTR_CANDIDATES = ("app", "_app")
+
+asgi_app = None
+for _attr in _ASGI_ATTR_CANDIDATES:
+    _candidate = getattr(app, _attr, None)
+    if callable(_candidate):
+        asgi_app = _candidate
+        print(f"Found ASGI app at app.{_attr}")
+        break
+else:
+    _router = getattr(app, 'router', None)
+    if _router is not None and hasattr(_router, 'app'):
+        asgi_app = _router.app
         print("Found ASGI app at app.router.app")
-    else:
+
+if asgi_app is None:
+    # Fallback: We'll need to use a different startup approach
+    # asgi_app stays None to indicate we need app.start() instead
+    print("Error accessing ASGI app: Could not find ASGI app attribute")
+    if CFG.is_development:
         # Debug: print available attributes to help identify the correct one
         print("Available App attributes:")
         attrs = [attr for attr in dir(app) if not attr.startswith('__')]
@@ -102,21 +562,12 @@ try:
                 print(f"  {attr}: callable")
             else:
                 print(f"  {attr}: {type(obj).__name__}")
-        
-        # If we can't find it, we'll need to use app.start() instead
-        # For now, raise an error to see what's available
-        raise AttributeError("Could not find ASGI app attribute. App attributes printed above.")
-except Exception as e:
-    print(f"Error accessing ASGI app: {e}")
-    # Fallback: We'll need to use a different startup approach
-    # Set asgi_app to None to indicate we need app.start() instead
-    asgi_app = None
     print("ASGI app not found - will need to use app.start() method")
 
 # Debug: Print when module is loaded (for Azure deployment verification)
 print("=" * 50)
 print("Bot application module loaded successfully")
-print(f"Environment: {os.getenv('ENVIRONMENT', 'production')}")
+print(f"Environment: {CFG.environment or 'production'}")
 if asgi_app:
     print(f"ASGI app type: {type(asgi_app)}")
     print(f"ASGI app callable: {callable(asgi_app)}")
@@ -124,12 +575,49 @@ else:
     print("ASGI app not available - using app.start() method")
 print("=" * 50)
 
-"""
-@app.on_message_pattern(re.compile(r"hello|hi|greetings"))
-async def handle_greeting(ctx: ActivityContext[MessageActivity]) -> None:
-    await ctx.send("Hello! How can I assist you today?")
+@app.event("start")
+async def warm_mcp_tools(_event) -> None:
+    """
+    Fetch the MCP tool lists from both servers concurrently at startup
+    so the first user message doesn't pay for the discovery handshakes.
+    Lists still fresh in the on-disk cache are reused instead of fetched,
+    and freshly fetched lists are saved back for the next restart.
+    """
+    try:
+        _, mcp_plugin = await get_chat_prompt_and_plugin()
+        await mcp_plugin.on_build_functions([])
+    except Exception:
+        logger.warning("MCP tool warm-up failed, tools will be fetched on first message", exc_info=True)
+        return
+    await persist_mcp_tools(mcp_plugin)
+
+
+@app.event("stop")
+async def close_http_client(_event) -> None:
+    """Close the pooled Azure OpenAI connections on shutdown."""
+    await azure_http_client.aclose()
+
+
+# Plain greetings and thank-yous are answered locally without an LLM round-trip
+# The patterns are anchored so words that merely contain a greeting ("philip") don't match,
+# and longer messages skip the regexes entirely since no greeting is that long
+GREETING_MAX_LENGTH = 32
+GREETING_RE = re.compile(
+    r"^\s*(hi|hello|hey|greetings)(\s+(there|all|team|billi))?[!. ]*$",
+    re.IGNORECASE,
+)
+GREETING_REPLY = "Hi! How can I help you today?"
+THANKS_RE = re.compile(
+    r"^\s*(thanks|thank you)(\s+(there|all|team|billi))?[!. ]*$",
+    re.IGNORECASE,
+)
+THANKS_REPLY = "You're welcome! Let me know if there's anything else I can help with."
+
+# Longer messages are cut before they reach the LLM, bounding prompt tokens and prefill time
+# per request (~4 characters per token, so roughly 4000 tokens)
+MAX_INPUT_CHARS = 16000
+TRUNCATION_MARKER = "\n[...truncated]"
 
-"""
 
 @app.on_message
 async def handle_message(ctx: ActivityContext[MessageActivity]):
@@ -138,169 +626,169 @@ async def handle_message(ctx: ActivityContext[MessageActivity]):
     The MCP server handles all tool execution and business logic.
     Maintains conversation history to preserve context.
     """
-    await ctx.reply(TypingActivityInput())
-
     try:
         user_message = ctx.activity.text
         conversation_id = ctx.activity.conversation.id
         
-        # Extract user metadata from the message activity
-        # This provides context about who is making the request
-        user_info = {"name": "", "id": "", "aad_object_id": ""}
+        if user_message and len(user_message) < GREETING_MAX_LENGTH:
+            if GREETING_RE.match(user_message):
+                await ctx.reply(GREETING_REPLY)
+                return
+            if THANKS_RE.match(user_message):
+                await ctx.reply(THANKS_REPLY)
+                return
         
-        # Try to access user information from the activity
-        # Microsoft Teams activities have 'from_property' or 'from' attribute with user info
-        # Use getattr to avoid conflicts with Python's 'from' keyword
-        user_from = None
-        if hasattr(ctx.activity, 'from_property'):
-            user_from = getattr(ctx.activity, 'from_property', None)
-        if not user_from and hasattr(ctx.activity, 'from'):
-            user_from = getattr(ctx.activity, 'from', None)
+        if user_message and len(user_message) > MAX_INPUT_CHARS:
+            logger.info("Truncating %d-character message to %d", len(user_message), MAX_INPUT_CHARS)
+            user_message = user_message[:MAX_INPUT_CHARS] + TRUNCATION_MARKER
         
-        if user_from:
-            # Extract user properties safely
-            if hasattr(user_from, 'name'):
-                user_info["name"] = user_from.name or ""
-            if hasattr(user_from, 'id'):
-                user_info["id"] = user_from.id or ""
-            if hasattr(user_from, 'aad_object_id'):
-                user_info["aad_object_id"] = user_from.aad_object_id or ""
-            elif hasattr(user_from, 'aadObjectId'):
-                user_info["aad_object_id"] = user_from.aadObjectId or ""
+        # The sender's account is on 'from_' ('from' is a Python keyword)
+        # Only the sender's name is used downstream (prompt context and tool parameters)
+        user_name = ctx.activity.from_.name or ""
         
-        # Debug: Print user info to verify extraction (remove in production if needed)
-        if user_info.get("name"):
-            print(f"User metadata extracted: {user_info}")
+        # Reuse the cached user context unless the sender's name changed
+        cached_context = user_context_cache.get(conversation_id)
+        if cached_context and cached_context[0] == user_name:
+            _, user_context_prefix, user_metadata_note = cached_context
+        else:
+            # Debug: Log user info to verify extraction (only formatted when DEBUG is enabled)
+            if user_name:
+                logger.debug("User metadata extracted: name=%s", user_name)
+            
+            # Include user metadata naturally in the context for tools that need userName/sender
+            user_context_prefix = f"User ({user_name})" if user_name else "User"
+            
+            # User metadata goes into the input, not the instructions, so the system prompt stays
+            # byte-identical across turns and the provider's prompt-prefix cache can reuse it
+            user_metadata_note = ""
+            if user_name:
+                user_metadata_note = f"## CURRENT USER CONTEXT\nThe person making this request is: {user_name}. Use this name for tools that require userName or sender parameters.\n\n"
+            user_context_cache[conversation_id] = (user_name, user_context_prefix, user_metadata_note)
         
         # Initialize conversation history if this is a new conversation
-        if conversation_id not in conversation_history:
-            conversation_history[conversation_id] = []
+        # The deque is capped at HISTORY_MAX_LINES, so memory per conversation stays bounded
+        history = conversation_history.get(conversation_id)
+        if history is None:
+            history = conversation_history[conversation_id] = deque(maxlen=HISTORY_MAX_LINES)
+        
+        # Serve repeated / near-duplicate questions from the response cache - exact match first,
+        # then semantic match if enabled
+        # Entries are scoped to this sender in this conversation; follow-ups that depend on the
+        # previous turn are kept out by is_cacheable
+        # The key is computed even with the cache disabled because it also keys in-flight calls
+        cache_key = cache_scope = cache_embedding = embed_task = None
+        embed_for_store = False
+        if ResponseCache.is_cacheable(user_message):
+            cache_scope = ResponseCache.key_for(f"{conversation_id}\n{ctx.activity.from_.id}")
+            cache_key = ResponseCache.key_for(f"{cache_scope}\n{user_message}")
+            cached_response = await response_cache.get(cache_key)
+            if cached_response is None and response_cache.semantic_enabled:
+                # Only the message is embedded so a long earlier reply can't dominate the vector
+                # The embedding is only awaited up front when this scope has entries to compare against;
+                # otherwise it is fetched alongside the LLM call, just to store the reply
+                if response_cache.has_semantic_entries(cache_scope):
+                    cache_embedding = await response_cache.embed(user_message)
+                    if cache_embedding is not None:
+                        cached_response = await response_cache.lookup(cache_scope, cache_embedding)
+                else:
+                    embed_for_store = True
+            if cached_response:
+                history.append(f"User: {user_message}")
+                history.append(f"Assistant: {cached_response}")
+                await ctx.reply(cached_response)
+                return
         
         # Build conversation context: include previous messages so MCP server has full context
         # This preserves context that the MCP server needs (like dates, names, etc.)
         # The MCP server needs to see the full conversation to maintain context
-        # Include user metadata naturally in the context for tools that need userName/sender
-        user_name = user_info.get('name', '')
-        user_context_prefix = f"User ({user_name})" if user_name else "User"
-        
         # Build contextual input with user metadata
-        if len(conversation_history[conversation_id]) > 0:
+        if history:
             # Include recent conversation history for context (last 5 exchanges)
-            recent_history = conversation_history[conversation_id][-5:]  # Last 5 messages for context
-            context_summary = "\n".join([
-                f"User: {msg['content']}" if msg['role'] == 'user' else f"Assistant: {msg['content']}"
-                for msg in recent_history
-            ])
-            contextual_input = f"Conversation history:\n{context_summary}\n\n{user_context_prefix} request: {user_message}"
+            context_summary = "\n".join(history)
+            contextual_input = f"{user_metadata_note}Conversation history:\n{context_summary}\n\n{user_context_prefix} request: {user_message}"
         else:
-            contextual_input = f"{user_context_prefix} request: {user_message}"
+            contextual_input = f"{user_metadata_note}{user_context_prefix} request: {user_message}"
         
-        # Add user metadata to instructions dynamically if available
-        user_metadata_note = ""
-        if user_name:
-            user_metadata_note = f"\n\n## CURRENT USER CONTEXT\nThe person making this request is: {user_name}. Use this name for tools that require userName or sender parameters."
+        # Stream the reply as it is generated in 1:1 chats (Teams only supports streaming there)
+        # ctx.stream batches emitted chunks and flushes them on a short timer to stay under the
+        # connector's rate limits, then sends the final message once the handler returns
+        stream_reply = ctx.activity.conversation.conversation_type == "personal"
         
-        base_instructions = """CRITICAL SYSTEM REQUIREMENT
-You MUST NOT use emojis, special characters, or any Unicode characters above ASCII 255.
-Use only plain text: letters (A-Z, a-z), numbers (0-9), and basic punctuation (. , ! ? - ' ").
-Violations will cause system errors. This is a hard technical constraint.
-
-You are Billi, a friendly and efficient assistant for ARVAYA Consulting.
-
-## YOUR ROLE
-You are a THIN CLIENT that routes user requests to MCP server tools. The MCP servers handle ALL intelligence, date parsing, business logic, and data processing. You do NOT interpret, convert, or process dates, times, or any data - you ONLY call tools with the exact information from the user.
-
-## YOUR AVAILABLE TOOLS
-
-### Time Entry Tool (from time entry MCP server):
-- process_time_entry - Submit time entries to QuickBooks and Monday.com
-  When to use: User mentions logging time, time entry, hours worked, submitting time
-  Required: messageText (use the EXACT user message), userName
-
-### Calendar Tools (from calendar MCP server):
-- get_users_with_name_and_email - Find user email addresses by name
-  When to use: User mentions a person's name and you need their email address
-  
-- check_availability - Check calendar availability for a user
-  When to use: User asks about availability, free time, when someone is available, schedule
-  Required: user_email (get from get_users_with_name_and_email first if only name provided)
-  IMPORTANT: Pass dates/times EXACTLY as the user said them - "tomorrow", "next Monday", "1/3/2026", etc. The MCP server will parse them.
-  
-- book_meeting - Book a meeting in a user's calendar
-  When to use: User wants to schedule, book, or set up a meeting, appointment
-  Required: user_email, subject, start_datetime, end_datetime, sender
-  IMPORTANT: Pass dates/times EXACTLY as the user said them. DO NOT convert "tomorrow" to a date - pass "tomorrow" to the MCP server.
-
-## USER CONTEXT
-The user making this request is identified in the message. Use their name when tools require a sender or userName parameter.
-
-## CRITICAL INSTRUCTIONS - READ CAREFULLY
-
-1. DO NOT interpret or convert dates/times. If user says "tomorrow", pass "tomorrow" to MCP tools. If user says "1/3/2026", pass "1/3/2026". The MCP server handles ALL date parsing.
-
-2. DO NOT add your own date interpretations to responses. Only use dates that come back from MCP tool results.
-
-3. When a user asks about availability or booking:
-   - DO NOT just greet them - IMMEDIATELY use the appropriate tool
-   - If they mention a person's name, call get_users_with_name_and_email FIRST to get their email
-   - Then call check_availability or book_meeting with the email address
-   - Pass dates/times EXACTLY as the user provided them - the MCP server will parse them correctly
-
-4. For book_meeting, the sender parameter should be the name of the person making the request (from the user context).
-5. For process_time_entry, the userName parameter should be the name of the person making the request (from the user context).
-
-6. Tool Usage Examples:
-   - User: "check availability of David Hogg" -> call get_users_with_name_and_email("David Hogg"), then check_availability with returned email
-   - User: "book a meeting with Sarah tomorrow at 2pm" -> call get_users_with_name_and_email("Sarah"), then book_meeting with start_datetime="tomorrow 2pm" (NOT a converted date)
-   - User: "book Ryan for 1/3/2026 at 9am" -> call get_users_with_name_and_email("Ryan"), then book_meeting with start_datetime="1/3/2026 9am"
-   - User: "who is John Smith" -> call get_users_with_name_and_email("John Smith")
-   - User: "log 4 hours for project X" -> call process_time_entry with messageText="log 4 hours for project X"
-
-## DATE/TIME HANDLING - CRITICAL
-- The MCP servers handle ALL date parsing, timezone conversion, and business logic
-- You MUST pass dates/times EXACTLY as the user provides them: "tomorrow", "today", "next Monday", "1/3/2026", "2pm", etc.
-- DO NOT convert "tomorrow" to "October 27th" or any specific date - pass "tomorrow" to the MCP server
-- DO NOT interpret relative dates - let the MCP server do it
-- Only use specific dates in your responses if they come from MCP tool results
-
-## COMMUNICATION STYLE
-- First interaction: Brief greeting only if no action is requested
-- When user requests an action: Execute the tool IMMEDIATELY with exact user input, then confirm the result
-- Be concise and action-oriented
-- After tool execution, provide a clear summary using information from the tool results"""
+        chat_prompt, mcp_plugin = await get_chat_prompt_and_plugin()
+        # Join an identical question that is already being answered instead of calling the LLM again;
+        # only the caller that started the call streams and caches the answer
+        send_task = inflight_requests.get(cache_key) if cache_key is not None else None
+        shared_call = send_task is not None
+        if not shared_call:
+            if not llm_limiter.reserve():
+                logger.warning("LLM queue full (%d pending), rejecting message", llm_limiter.pending)
+                await ctx.reply(BUSY_REPLY)
+                return
+            # All volatile data (user name, history) travels in the user message after the static
+            # instructions, so every call shares the same cacheable prompt prefix
+            send_task = asyncio.create_task(llm_limiter.run(chat_prompt.send(
+                input=contextual_input,  # Include conversation history for MCP server context
+                instructions=SYSTEM_MESSAGE,
+                on_chunk=ctx.stream.emit if stream_reply else None
+            )))
+            if embed_for_store:
+                embed_task = asyncio.create_task(response_cache.embed(user_message))
+            if cache_key is not None:
+                inflight_requests[cache_key] = send_task
+                send_task.add_done_callback(lambda _: inflight_requests.pop(cache_key, None))
         
-        # Append user metadata note if available
-        full_instructions = base_instructions + user_metadata_note
+        # Only the caller that started the call streams; a caller that joined replies once it's done
+        streamed = stream_reply and not shared_call
         
-        result = await chat_prompt.send(
-            input=contextual_input,  # Include conversation history for MCP server context
-            instructions=full_instructions
-        )
+        # Only show the typing indicator if the LLM call is slow - fast replies then need
+        # a single outbound call to the Bot Framework connector instead of two
+        # Streamed replies skip it: the stream sends its own typing activities and may already show text
+        done, _ = await asyncio.wait({send_task}, timeout=TYPING_INDICATOR_DELAY)
+        typing_task = None
+        if not done and not streamed:
+            # Sent in the background so waiting on the LLM isn't held up by the typing round trip
+            typing_task = asyncio.create_task(ctx.reply(TypingActivityInput()))
+        try:
+            # Shielded so one caller being cancelled doesn't cancel a call others are waiting on
+            result = await asyncio.shield(send_task)
+        finally:
+            # Settle the typing indicator before any reply so it can't land after the answer
+            if typing_task is not None:
+                try:
+                    await typing_task
+                except Exception:
+                    logger.warning("Failed to send typing indicator", exc_info=True)
         
         if result.response and result.response.content:
             ai_response = result.response.content
             # Add both user message and AI response to conversation history for next iteration
-            conversation_history[conversation_id].append({
-                "role": "user",
-                "content": user_message
-            })
-            conversation_history[conversation_id].append({
-                "role": "assistant",
-                "content": ai_response
-            })
-            await ctx.reply(ai_response)
+            # A joined call is a repeat in the same conversation, already recorded by the caller that started it
+            if not shared_call:
+                history.append(f"User: {user_message}")
+                history.append(f"Assistant: {ai_response}")
+            if cache_key is not None and cache_scope is not None and not shared_call:
+                if embed_task is not None:
+                    cache_embedding = await embed_task
+                await response_cache.store(cache_key, ai_response, cache_scope, cache_embedding)
+            # Streamed replies were already delivered chunk by chunk
+            if not streamed:
+                await ctx.reply(ai_response)
+            # The plugin refetches expired tool lists during send - keep the disk copy current
+            if not shared_call:
+                await persist_mcp_tools(mcp_plugin)
         else:
             await ctx.reply("I'm sorry, I couldn't generate a response.")
     
-    except Exception as e:
-        error_msg = str(e)
-        print(f"Error: {error_msg}")  # Debug logging
-        await ctx.reply(f"Sorry, I encountered an error: {error_msg}")
+    except Exception:
+        # Details stay in the logs; exception text can carry URLs, keys or server internals
+        logger.exception("Error handling message")
+        await ctx.reply("Sorry, I encountered an error. Please try again.")
 
 
 # Local development: use app.start() which includes DevToolsPlugin support
 def main():
-    asyncio.run(app.start())
+    # uvloop's libuv-based loop schedules tasks and handles sockets faster than the default loop
+    asyncio.run(app.start(), loop_factory=uvloop.new_event_loop if uvloop else None)
 
 
 if __name__ == "__main__":